@@ -3,8 +3,11 @@
 import streamlit as st
 import polars as pl
 from rapidfuzz import fuzz
-import tempfile
+import io
+import hashlib
+import xlsxwriter
 import math
+from functools import partial
 
 st.title("⚡️ Batch Bio Data Mismatch Detector (1.8M+ rows)")
 
@@ -12,104 +15,335 @@ st.title("⚡️ Batch Bio Data Mismatch Detector (1.8M+ rows)")
 finacle_file = st.file_uploader("Upload Finacle CSV", type="csv")
 basis_file = st.file_uploader("Upload Basis CSV", type="csv")
 
+KEY_COLS = ["name", "dob", "email"]
+FINACLE_PHONES = ["preferredphone", "smsbankingnumber"]
+BASIS_PHONES = ["tel_num", "tel_num_2", "fax_num", "mob_num"]
+EXACT_COLS = KEY_COLS + ["phones"]
+# Uploads above this size are collected with the streaming engine
+STREAMING_BYTES = 200 * 1024 * 1024
+# Row values handed to the scorer, in order
+SCORED_FIELDS = ["name_sorted", "dob", "email_sorted", "phones"]
+SCORERS = [fuzz.ratio, fuzz.ratio, fuzz.ratio, fuzz.partial_ratio]
+# A shared DOB or phone narrows a row's pool to the basis rows holding it. A shared email or
+# name only widens a pool that is already narrowed: a common name alone would otherwise cut
+# a row off from its real match when that match has typos
+BLOCK_FIELDS = ["dob"]
+WIDEN_FIELDS = ["name_sorted", "email_sorted"]
+
 # Matching helper
-def normalize(val):
-    return str(val).strip().lower() if val and val != "null" else ""
+def normalize(df, phone_cols):
+    # Every column to stripped lowercase text in a single pass; nulls and "null" become "".
+    # Phones keep only their digits, so "024-455 1234" and "0244551234" agree
+    return df.with_columns(
+        pl.col(KEY_COLS).str.strip_chars().str.to_lowercase().replace("null", "").fill_null(""),
+        pl.col(phone_cols).str.replace_all(r"[^0-9]", "").fill_null(""),
+    )
 
-def combine_phones(row, cols):
-    return " ".join([normalize(row.get(col, "")) for col in cols])
+def compare(f_vals, b_vals, floor=0):
+    # Returns 0 as soon as the candidate can no longer score above ``floor``
+    fields = [(scorer, f, b) for scorer, f, b in zip(SCORERS, f_vals, b_vals) if f and b]
 
-def compare(f_row, b_row):
-    scores = []
+    if not fields:
+        return 0
 
-    if f_row.get("name") and b_row.get("name"):
-        scores.append(fuzz.token_sort_ratio(normalize(f_row["name"]), normalize(b_row["name"])))
+    total = 0
+    remaining = len(fields)
+    for scorer, f_val, b_val in fields:
+        remaining -= 1
+        # Lowest score this field can take while the average still beats the floor
+        cutoff = floor * len(fields) - total - 100 * remaining
+        if cutoff > 100:
+            return 0
+        score = scorer(f_val, b_val, score_cutoff=max(cutoff, 0))
+        if score < cutoff:
+            return 0
+        total += score
 
-    if f_row.get("dob") and b_row.get("dob"):
-        scores.append(fuzz.ratio(normalize(f_row["dob"]), normalize(b_row["dob"])))
+    return total / len(fields)
 
-    if f_row.get("email") and b_row.get("email"):
-        scores.append(fuzz.token_sort_ratio(normalize(f_row["email"]), normalize(b_row["email"])))
+def find_best(f_idx, f_vals, b_records, candidates):
+    pool = sorted(candidates.get(f_idx, ())) or range(len(b_records))
 
-    f_phone = combine_phones(f_row, ["preferredphone", "smsbankingnumber"])
-    b_phone = combine_phones(b_row, ["tel_num", "tel_num_2", "fax_num", "mob_num"])
-    if f_phone and b_phone:
-        scores.append(fuzz.partial_ratio(f_phone, b_phone))
+    best_score = 0
+    best_row = None
 
-    return sum(scores) / len(scores) if scores else 0
+    for j in pool:
+        score = compare(f_vals, b_records[j], best_score)
+        if score > best_score:
+            best_score = score
+            best_row = j
+            # Nothing can beat a perfect score; skip the rest of the pool
+            if best_score == 100:
+                break
 
-if finacle_file and basis_file:
-    threshold = st.slider("Match Score Threshold", 0, 100, 85)
-    batch_size = st.number_input("Batch Size", value=10000, step=1000)
+    return best_score, best_row
 
-    with tempfile.NamedTemporaryFile(delete=False) as f_tmp, tempfile.NamedTemporaryFile(delete=False) as b_tmp:
-        f_tmp.write(finacle_file.read())
-        b_tmp.write(basis_file.read())
+def upload_key(file):
+    # Digest of an upload's bytes, so the same file uploaded again still hits the caches.
+    # Worked out once per upload and kept in the session, so widget reruns don't re-hash it
+    digests = st.session_state.setdefault("upload_digests", {})
+    if file.file_id not in digests:
+        digests[file.file_id] = hashlib.blake2b(file.getbuffer(), digest_size=16).hexdigest()
+    return digests[file.file_id]
 
-    st.info("Reading CSVs with Polars...")
-    finacle = pl.read_csv(f_tmp.name).unique(subset=["name", "dob", "email"])
-    basis = pl.read_csv(b_tmp.name).unique(subset=["name", "dob", "email"])
+def plan_file(file, phone_cols):
+    # Lazy load of one upload, down to the columns the matcher needs
+    # Every column is read as text: no inference pass, and phones keep their leading zeros
+    lf = pl.scan_csv(io.BytesIO(file.getvalue()), infer_schema=False)
+    present = lf.collect_schema().names()
+    # Only the compared columns are parsed; the rest of the export never leaves the scanner
+    present_phones = [c for c in phone_cols if c in present]
+    lf = lf.select(KEY_COLS + present_phones)
+    # Matching reads the cleaned columns; the report shows the values as uploaded
+    uploaded_phones = [pl.col(c) if c in present else pl.lit(None, dtype=pl.Utf8) for c in phone_cols]
+    lf = lf.with_columns(
+        pl.col(KEY_COLS).name.prefix("original_"),
+        pl.concat_str(uploaded_phones, separator=" ", ignore_nulls=True).alias("original_phones"),
+    )
+    lf = normalize(lf, present_phones).unique(subset=KEY_COLS, maintain_order=True)
+    # Phones are scored as one string; build it once per row rather than once per pair
+    phones = [pl.col(c) if c in present else pl.lit("") for c in phone_cols]
+    return lf.with_columns(
+        pl.concat_list(phones).list.eval(pl.element().filter(pl.element() != "")).list.join(" ").alias("phones"),
+        # token_sort_ratio == ratio over the sorted tokens, so sort each value once up front
+        *[pl.col(c).str.extract_all(r"\S+").list.sort().list.join(" ").alias(f"{c}_sorted") for c in ("name", "email")],
+    )
 
-    st.success(f"Loaded Finacle: {len(finacle)} rows, Basis: {len(basis)} rows.")
+@st.cache_resource(show_spinner=False, max_entries=2)
+def load_files(finacle_key, basis_key, _finacle_file, _basis_file):
+    # Keyed on the uploads' digests, so widget reruns neither re-parse nor re-hash the files.
+    # cache_resource hands reruns the frames themselves rather than unpickled copies; nothing
+    # modifies them in place. The two plans are independent, so collect_all runs them concurrently
+    large = max(_finacle_file.size, _basis_file.size) > STREAMING_BYTES
+    return pl.collect_all(
+        [plan_file(_finacle_file, FINACLE_PHONES), plan_file(_basis_file, BASIS_PHONES)],
+        engine="streaming" if large else "auto",
+    )
+
+def phone_keys(df, cols):
+    # One (row, phone) pair per distinct real phone, as an integer key sorted so the join can merge
+    phones = [pl.col(c) if c in df.columns else pl.lit("") for c in cols]
+    return (
+        df.lazy()
+        .with_row_index("row")
+        .select("row", pl.concat_list(phones).list.unique().alias("phone"))
+        .explode("phone")
+        .select("row", pl.col("phone").cast(pl.UInt64, strict=False))
+        .filter(pl.col("phone") > 0)
+        .sort("phone")
+        .with_columns(pl.col("phone").set_sorted())
+    )
+
+def block_keys(df, fields):
+    # One (row, field, value) triple per non-empty value of ``fields``, in a single long table.
+    # Values are joined as UInt64 hashes; a collision only adds a candidate, never drops one
+    lf = df.lazy().with_row_index("row")
+    return pl.concat(
+        [
+            lf.filter(pl.col(c) != "").select("row", pl.lit(i, dtype=pl.UInt8).alias("field"), pl.col(c).hash().alias("value"))
+            for i, c in enumerate(fields)
+        ]
+    )
+
+def join_blocks(rows, f_keys, b_keys, on):
+    # (row, row_basis) for each of the finacle ``rows`` sharing a key with a basis row
+    return (
+        f_keys.lazy()
+        .join(rows, on="row", how="semi")
+        .join(b_keys.lazy(), on=on, how="inner", suffix="_basis")
+        .select("row", "row_basis")
+    )
 
-    f_records = finacle.to_dicts()
-    b_records = basis.to_dicts()
+def batch_candidates(rows, keys):
+    # Basis rows each of ``rows`` shares a DOB or phone number with, plus those sharing its name
+    # or email when there are any. Built one batch at a time, so only this batch's pairs are
+    # ever held as Python lists
+    f_blocks, b_blocks, f_widen, b_widen, f_phones, b_phones = keys
+    batch = pl.LazyFrame({"row": rows}, schema={"row": pl.UInt32})
+    pairs = pl.concat(
+        [
+            join_blocks(batch, f_blocks, b_blocks, ["field", "value"]),
+            join_blocks(batch, f_phones, b_phones, "phone"),
+        ]
+    )
+    blocked = batch.join(pairs, on="row", how="semi")
+    return dict(
+        pl.concat([pairs, join_blocks(blocked, f_widen, b_widen, ["field", "value"])])
+        .group_by("row")
+        .agg(pl.col("row_basis").unique())
+        .collect()
+        .iter_rows()
+    )
 
-    # Index basis by DOB
-    dob_index = {}
-    for b_row in b_records:
-        dob = normalize(b_row.get("dob", ""))
-        if dob:
-            dob_index.setdefault(dob, []).append(b_row)
+def fuzzy_match(finacle, basis, rows, batch_size):
+    # (best score, best basis row) for each of ``rows`` of finacle, in order
+    # Field tuples pulled out once per row, so the pair loop never touches a dict
+    f_records = finacle.select(pl.col(SCORED_FIELDS).gather(rows)).rows()
+    b_records = basis.select(SCORED_FIELDS).rows()
 
-    mismatches = []
-    total_matches = 0
+    # A row is only scored against basis rows it shares an exact DOB or phone number with, widened
+    # by its exact (token-sorted) name and email. The key tables are built once: basis in full,
+    # finacle only for ``rows``, so rows already settled as exact twins never reach the joins
+    pending = pl.LazyFrame({"row": rows}, schema={"row": pl.UInt32})
+    keys = pl.collect_all(
+        [
+            block_keys(finacle, BLOCK_FIELDS).join(pending, on="row", how="semi"),
+            block_keys(basis, BLOCK_FIELDS),
+            block_keys(finacle, WIDEN_FIELDS).join(pending, on="row", how="semi"),
+            block_keys(basis, WIDEN_FIELDS),
+            phone_keys(finacle, FINACLE_PHONES).join(pending, on="row", how="semi"),
+            phone_keys(basis, BASIS_PHONES),
+        ]
+    )
 
-    total_batches = math.ceil(len(f_records) / batch_size)
+    results = []
+    total_batches = math.ceil(len(rows) / batch_size)
+    progress = st.progress(0.0, text="Scoring candidates...")
 
+    # Scored on this thread: the per-pair fuzz calls hold the GIL, so a thread pool only adds contention
     for i in range(total_batches):
-        st.info(f"Processing batch {i+1}/{total_batches}...")
         start = i * batch_size
         end = start + batch_size
-        batch = f_records[start:end]
-
-        for f_row in batch:
-            f_dob = normalize(f_row.get("dob", ""))
-            pool = dob_index.get(f_dob, b_records)
-
-            best_score = 0
-            best_match = None
-
-            for b_row in pool:
-                score = compare(f_row, b_row)
-                if score > best_score:
-                    best_score = score
-                    best_match = b_row
-
-            if best_score < threshold:
-                mismatches.append({
-                    "finacle_name": f_row.get("name", ""),
-                    "finacle_dob": f_row.get("dob", ""),
-                    "finacle_email": f_row.get("email", ""),
-                    "finacle_phones": combine_phones(f_row, ["preferredphone", "smsbankingnumber"]),
-                    "basis_name": best_match.get("name", "") if best_match else "",
-                    "basis_email": best_match.get("email", "") if best_match else "",
-                    "basis_phones": combine_phones(best_match, ["tel_num", "tel_num_2", "fax_num", "mob_num"]) if best_match else "",
-                    "match_score": best_score
-                })
-            else:
-                total_matches += 1
-
-        st.success(f"✅ Batch {i+1} complete — Matches: {total_matches}, Mismatches so far: {len(mismatches)}")
-
-    st.success(f"✅ Done! Total Matches: {total_matches}, Mismatches: {len(mismatches)}")
-
-    if mismatches:
-        import pandas as pd
-        mismatch_df = pd.DataFrame(mismatches)
+        candidates = batch_candidates(rows[start:end], keys)
+        match = partial(find_best, b_records=b_records, candidates=candidates)
+        results.extend(map(match, rows[start:end], f_records[start:end]))
+
+        progress.progress((i + 1) / total_batches, text=f"Scored batch {i+1}/{total_batches}")
+
+    return results
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def score_rows(finacle_key, basis_key, _finacle_file, _basis_file, _batch_size):
+    # Scores don't depend on the threshold, so moving the slider only re-filters. Nor on the
+    # batch size, which only sets progress granularity, so it isn't part of the cache key
+    finacle, basis = load_files(finacle_key, basis_key, _finacle_file, _basis_file)
+
+    best_scores = [0.0] * finacle.height
+    best_rows = [None] * finacle.height
+
+    # A row equal to a basis row on every compared field scores the maximum 100, so only
+    # the anti-join remainder needs fuzzy scoring. Join on one UInt64 hash of the compared
+    # fields, then confirm the fields themselves so a hash collision can't fake a twin
+    twin_key = pl.struct(EXACT_COLS).hash().alias("twin_key")
+    f_keys = finacle.select(EXACT_COLS).with_row_index("row").with_columns(twin_key)
+    b_keys = (
+        basis.select(EXACT_COLS)
+        .with_row_index("basis_row")
+        .with_columns(twin_key)
+        .unique(subset="twin_key", keep="first", maintain_order=True)
+    )
+    twins = (
+        f_keys.filter(pl.any_horizontal(pl.col(EXACT_COLS) != ""))
+        .join(b_keys, on="twin_key", how="inner", suffix="_basis")
+        .filter(pl.all_horizontal(pl.col(c) == pl.col(f"{c}_basis") for c in EXACT_COLS))
+    )
+    for row, basis_row in twins.select("row", "basis_row").iter_rows():
+        best_scores[row] = 100.0
+        best_rows[row] = basis_row
+    to_score = f_keys.join(twins, on="row", how="anti").get_column("row").to_list()
+
+    # Nothing left for the fuzzy pass (e.g. the same extract uploaded twice): skip the indexes too
+    if to_score:
+        for row, (best_score, best_row) in zip(to_score, fuzzy_match(finacle, basis, to_score, _batch_size)):
+            best_scores[row] = best_score
+            best_rows[row] = best_row
+
+    return pl.DataFrame(
+        [
+            pl.Series("basis_row", best_rows, dtype=pl.UInt32),
+            pl.Series("match_score", best_scores, dtype=pl.Float64),
+        ]
+    )
+
+@st.cache_data(show_spinner=False, max_entries=6)
+def export_mismatches(fmt, finacle_key, basis_key, threshold, _mismatch_df):
+    # Each format is cached on its own, for a few recent uploads and thresholds
+    if fmt == "csv":
+        return _mismatch_df.write_csv().encode("utf-8")
+
+    buffer = io.BytesIO()
+    if fmt == "parquet":
+        _mismatch_df.write_parquet(buffer, compression="zstd")
+    else:
+        # constant_memory flushes each row as it's written instead of holding the sheet in RAM
+        workbook = xlsxwriter.Workbook(buffer, {"constant_memory": True})
+        worksheet = workbook.add_worksheet("Mismatches")
+        worksheet.write_row(0, 0, _mismatch_df.columns)
+        for i, row in enumerate(_mismatch_df.iter_rows(), start=1):
+            worksheet.write_row(i, 0, row)
+        workbook.close()
+    return buffer.getvalue()
+
+if finacle_file and basis_file:
+    threshold = st.slider("Match Score Threshold", 0, 100, 85)
+    batch_size = st.number_input("Batch Size", min_value=1, value=10000, step=1000)
+
+    st.info("Reading CSVs with Polars...")
+    finacle_key, basis_key = upload_key(finacle_file), upload_key(basis_file)
+    finacle, basis = load_files(finacle_key, basis_key, finacle_file, basis_file)
+
+    st.success(f"Loaded Finacle: {len(finacle)} rows, Basis: {len(basis)} rows.")
+
+    scores = score_rows(finacle_key, basis_key, finacle_file, basis_file, batch_size)
+
+    # Split matches from mismatches with one columnar filter, then attach the best basis candidate
+    mismatch_df = (
+        pl.concat(
+            [
+                finacle.select(
+                    pl.col("original_name").alias("finacle_name"),
+                    pl.col("original_dob").alias("finacle_dob"),
+                    pl.col("original_email").alias("finacle_email"),
+                    pl.col("original_phones").alias("finacle_phones"),
+                ),
+                scores,
+            ],
+            how="horizontal",
+        )
+        .filter(pl.col("match_score") < threshold)
+        .join(
+            basis.select(
+                pl.col("original_name").alias("basis_name"),
+                pl.col("original_email").alias("basis_email"),
+                pl.col("original_phones").alias("basis_phones"),
+            ).with_row_index("basis_row"),
+            on="basis_row",
+            how="left",
+            maintain_order="left",
+        )
+        .select(
+            "finacle_name",
+            "finacle_dob",
+            "finacle_email",
+            "finacle_phones",
+            pl.col("basis_name", "basis_email", "basis_phones").fill_null(""),
+            "match_score",
+        )
+    )
+
+    total_matches = scores.height - mismatch_df.height
+    st.success(f"✅ Done! Total Matches: {total_matches}, Mismatches: {mismatch_df.height}")
+
+    if mismatch_df.height:
         st.dataframe(mismatch_df)
 
-        csv = mismatch_df.to_csv(index=False).encode("utf-8")
-        st.download_button("📥 Download Mismatches CSV", csv, "mismatches.csv", "text/csv")
+        # Downloads get a callable, so a format is only serialized when its button is clicked
+        export = partial(
+            export_mismatches,
+            finacle_key=finacle_key,
+            basis_key=basis_key,
+            threshold=threshold,
+            _mismatch_df=mismatch_df,
+        )
+        st.download_button("📥 Download Mismatches CSV", partial(export, "csv"), "mismatches.csv", "text/csv")
+        st.download_button("📥 Download Mismatches Parquet", partial(export, "parquet"), "mismatches.parquet", "application/octet-stream")
+        # One header row plus data has to fit in a single worksheet
+        if mismatch_df.height < 1_048_576:
+            st.download_button(
+                "📥 Download Mismatches Excel",
+                partial(export, "xlsx"),
+                "mismatches.xlsx",
+                "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            )
     else:
         st.info("🎉 No mismatches found!")